@@ -2,7 +2,18 @@
 """Gemini Image Generation MCP Server - Minimal implementation returning only file paths."""
 
 import os
+import mmap
+import time
 import asyncio
+import hashlib
+import itertools
+import traceback
+
+try:
+    import pybase64 as base64  # SIMD-accelerated, drop-in b64decode
+except ImportError:
+    import base64
+from collections import OrderedDict
 from pathlib import Path
 from datetime import datetime, timezone
 from typing import Any
@@ -11,7 +22,7 @@ from mcp.server import Server
 from mcp.server.stdio import stdio_server
 from mcp.types import Tool, TextContent
 from google import genai
-from google.genai.types import GenerateContentConfig, Part
+from google.genai.types import CreateCachedContentConfig, GenerateContentConfig, Part
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -29,50 +40,188 @@ if not OUTPUT_DIR_STR:
 OUTPUT_DIR = Path(OUTPUT_DIR_STR).expanduser()
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Plain-string form of the output directory; hot-path filename construction
+# uses os.path.join on strings to skip per-call PurePath allocation
+_OUTPUT_DIR_STR = os.fspath(OUTPUT_DIR)
+
 # Initialize Gemini client
 client = genai.Client(api_key=API_KEY)
 
+# Shared request config; the SDK treats it as read-only so one instance
+# serves every call
+_IMAGE_CONFIG = GenerateContentConfig(response_modalities=["image"])
+
 # Create MCP server
 app = Server("gemini-image-generator")
 
+# Gemini rejects inline images past ~10 MB; refuse them before reading
+_MAX_INPUT_IMAGE_BYTES = 10 * 1024 * 1024
+
+# MIME types by file suffix for input images
+_MIME_BY_SUFFIX = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+}
+
+
+def _detect_mime_type(header: bytes, suffix: str) -> str:
+    """Determine the image MIME type from magic bytes, falling back to suffix."""
+    if header.startswith(b"\x89PNG"):
+        return "image/png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "image/webp"
+    return _MIME_BY_SUFFIX.get(suffix, "image/png")
+
+
+# Per-process counter plus a random per-process tag keep output filenames
+# unique across concurrent saves within the same second and across restarts
+_file_counter = itertools.count()
+_process_tag = os.urandom(2).hex()
+
+
+def _utc_timestamp() -> str:
+    """Format the current UTC time as a compact ISO 8601 stamp (no strftime)."""
+    now = datetime.now(timezone.utc)
+    return (
+        f"{now.year:04d}{now.month:02d}{now.day:02d}"
+        f"T{now.hour:02d}{now.minute:02d}{now.second:02d}Z"
+    )
+
+
+# In-process result cache: request fingerprint -> saved image path.
+# Repeat prompts skip the Gemini round trip entirely and re-return the
+# previously saved file.
+_RESULT_CACHE_MAX_ENTRIES = 256
+_result_cache: OrderedDict[str, str] = OrderedDict()
+_result_cache_lock = asyncio.Lock()
+
+
+def _result_cache_key(*parts: bytes) -> str:
+    """Build a compact fingerprint for a generation request."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+async def _result_cache_get(key: str) -> str | None:
+    """Return the cached output path for key, or None on miss."""
+    async with _result_cache_lock:
+        filepath = _result_cache.get(key)
+        if filepath is None:
+            return None
+        if not os.path.exists(filepath):
+            # Output file was deleted out from under us; drop the entry
+            del _result_cache[key]
+            return None
+        _result_cache.move_to_end(key)
+        return filepath
+
+
+async def _result_cache_put(key: str, filepath: str) -> None:
+    """Record a generated output path, evicting the oldest entry if full."""
+    async with _result_cache_lock:
+        _result_cache[key] = filepath
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > _RESULT_CACHE_MAX_ENTRIES:
+            _result_cache.popitem(last=False)
+
+
+# Gemini explicit context cache: input-image fingerprint -> (cache name, expiry).
+# Repeat edits of the same image reference the server-side cached content by
+# name instead of re-uploading the bytes on every call. A None cache name
+# records that the content could not be cached so we don't retry every call.
+_CONTEXT_CACHE_TTL_SECONDS = 600
+_context_cache: dict[str, tuple[str | None, float]] = {}
+_context_cache_lock = asyncio.Lock()
+
+
+async def _get_context_cache_name(image_hash: str, image_data, mime_type: str) -> str | None:
+    """Return the Gemini cached-content name for an input image, creating it on miss."""
+    async with _context_cache_lock:
+        # Drop expired entries before looking up
+        now = time.monotonic()
+        for key in [k for k, (_, expiry) in _context_cache.items() if expiry <= now]:
+            del _context_cache[key]
+        entry = _context_cache.get(image_hash)
+        if entry is not None:
+            return entry[0]
 
-@app.list_tools()
-async def list_tools() -> list[Tool]:
-    """List available tools."""
-    return [
-        Tool(
-            name="generate_image_from_text",
-            description="Generate an image from a text prompt using Gemini 2.5 Flash. Returns only the file path.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "prompt": {
-                        "type": "string",
-                        "description": "Text description of the image to generate",
-                    }
+    try:
+        cache = await asyncio.to_thread(
+            client.caches.create,
+            model="gemini-2.5-flash-image",
+            config=CreateCachedContentConfig(
+                contents=[Part.from_bytes(data=bytes(image_data), mime_type=mime_type)],
+                ttl=f"{_CONTEXT_CACHE_TTL_SECONDS}s",
+            ),
+        )
+        cache_name = cache.name
+    except Exception:
+        # Content below the minimum cacheable size or caching unsupported;
+        # fall back to inline upload
+        cache_name = None
+
+    async with _context_cache_lock:
+        # Expire our record slightly before the server-side TTL does
+        _context_cache[image_hash] = (cache_name, time.monotonic() + _CONTEXT_CACHE_TTL_SECONDS - 30)
+    return cache_name
+
+
+# Tool schemas are static; build them once at import time instead of on
+# every tools/list request
+_TOOLS = [
+    Tool(
+        name="generate_image_from_text",
+        description="Generate an image from a text prompt using Gemini 2.5 Flash. Returns only the file path.",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "prompt": {
+                    "type": "string",
+                    "description": "Text description of the image to generate",
                 },
-                "required": ["prompt"],
+                "count": {
+                    "type": "integer",
+                    "description": "Number of images to generate concurrently",
+                    "minimum": 1,
+                    "maximum": 8,
+                    "default": 1,
+                }
             },
-        ),
-        Tool(
-            name="generate_image_from_image",
-            description="Transform or edit an existing image using Gemini 2.5 Flash. Returns only the file path.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "input_image_path": {
-                        "type": "string",
-                        "description": "Path to the input image file (supports ~/ expansion)",
-                    },
-                    "prompt": {
-                        "type": "string",
-                        "description": "Instruction for how to transform or edit the image",
-                    }
+            "required": ["prompt"],
+        },
+    ),
+    Tool(
+        name="generate_image_from_image",
+        description="Transform or edit an existing image using Gemini 2.5 Flash. Returns only the file path.",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "input_image_path": {
+                    "type": "string",
+                    "description": "Path to the input image file (supports ~/ expansion)",
                 },
-                "required": ["input_image_path", "prompt"],
+                "prompt": {
+                    "type": "string",
+                    "description": "Instruction for how to transform or edit the image",
+                }
             },
-        )
-    ]
+            "required": ["input_image_path", "prompt"],
+        },
+    )
+]
+
+
+@app.list_tools()
+async def list_tools() -> list[Tool]:
+    """List available tools."""
+    return _TOOLS
 
 
 @app.call_tool()
@@ -86,27 +235,46 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
         raise ValueError(f"Unknown tool: {name}")
 
 
+_MAX_IMAGES_PER_CALL = 8
+
+
 async def _generate_image_from_text(arguments: Any) -> list[TextContent]:
-    """Generate image from text prompt."""
+    """Generate one or more images from a text prompt."""
     prompt = arguments.get("prompt")
     if not prompt:
         raise ValueError("prompt is required")
 
-    try:
-        # Generate image
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-image",
-            contents=prompt,
-            config=GenerateContentConfig(
-                response_modalities=["image"],
-            ),
-        )
+    count = int(arguments.get("count", 1))
+    if not 1 <= count <= _MAX_IMAGES_PER_CALL:
+        raise ValueError(f"count must be between 1 and {_MAX_IMAGES_PER_CALL}")
 
-        # Extract and save image
-        return _save_generated_image(response)
+    # Re-return the existing file if this exact prompt was generated before
+    # (single-image requests only; batches are expected to vary)
+    cache_key = _result_cache_key(prompt.encode())
+    if count == 1:
+        cached = await _result_cache_get(cache_key)
+        if cached is not None:
+            return [TextContent(type="text", text=cached)]
+
+    try:
+        # Issue the generation requests concurrently off the event loop
+        responses = await asyncio.gather(*[
+            asyncio.to_thread(
+                client.models.generate_content,
+                model="gemini-2.5-flash-image",
+                contents=prompt,
+                config=_IMAGE_CONFIG,
+            )
+            for _ in range(count)
+        ])
+
+        # Extract and save images
+        filepaths = [await _save_generated_image(response) for response in responses]
+        if count == 1:
+            await _result_cache_put(cache_key, filepaths[0])
+        return [TextContent(type="text", text=filepath) for filepath in filepaths]
 
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         raise RuntimeError(f"Image generation failed: {type(e).__name__}: {str(e)}\n\nTraceback:\n{error_details}")
 
@@ -129,68 +297,115 @@ async def _generate_image_from_image(arguments: Any) -> list[TextContent]:
         if not input_path.is_file():
             raise ValueError(f"Input path is not a file: {input_path}")
 
-        # Read input image
+        # Fail fast on inputs the API would reject anyway, before reading
+        # (or even mapping) any bytes
+        size = input_path.stat().st_size
+        if size == 0:
+            raise ValueError(f"Input image is empty: {input_path}")
+        if size > _MAX_INPUT_IMAGE_BYTES:
+            raise ValueError(
+                f"Input image too large: {size} bytes (max {_MAX_INPUT_IMAGE_BYTES})"
+            )
+
+        # Map the input image instead of copying it into a bytes object;
+        # hashing reads the buffer in place and bytes are materialized only
+        # when an upload actually happens
         with open(input_path, "rb") as f:
-            image_data = f.read()
-
-        # Determine MIME type
-        suffix = input_path.suffix.lower()
-        mime_type_map = {
-            ".png": "image/png",
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".webp": "image/webp",
-        }
-        mime_type = mime_type_map.get(suffix, "image/png")
-
-        # Generate image with input image and prompt
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-image",
-            contents=[
-                Part.from_bytes(data=image_data, mime_type=mime_type),
-                prompt
-            ],
-            config=GenerateContentConfig(
-                response_modalities=["image"],
-            ),
-        )
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with mapped, memoryview(mapped) as image_data:
+            # Determine MIME type from the file's magic bytes so a mislabeled
+            # suffix doesn't cost a doomed API round trip
+            mime_type = _detect_mime_type(bytes(image_data[:12]), input_path.suffix.lower())
+
+            # Re-return the existing file for an identical (image, prompt) pair
+            cache_key = _result_cache_key(mime_type.encode(), image_data, prompt.encode())
+            cached = await _result_cache_get(cache_key)
+            if cached is not None:
+                return [TextContent(type="text", text=cached)]
+
+            # Upload the input image once and reference it by cache name on
+            # subsequent prompts; fall back to inline upload if uncacheable
+            image_hash = hashlib.blake2b(image_data, digest_size=16).hexdigest()
+            cache_name = await _get_context_cache_name(image_hash, image_data, mime_type)
+
+            # Generate image with input image and prompt (off the event loop)
+            if cache_name is not None:
+                response = await asyncio.to_thread(
+                    client.models.generate_content,
+                    model="gemini-2.5-flash-image",
+                    contents=[prompt],
+                    config=GenerateContentConfig(
+                        response_modalities=["image"],
+                        cached_content=cache_name,
+                    ),
+                )
+            else:
+                response = await asyncio.to_thread(
+                    client.models.generate_content,
+                    model="gemini-2.5-flash-image",
+                    contents=[
+                        Part.from_bytes(data=bytes(image_data), mime_type=mime_type),
+                        prompt
+                    ],
+                    config=_IMAGE_CONFIG,
+                )
 
         # Extract and save image
-        return _save_generated_image(response)
+        filepath = await _save_generated_image(response)
+        await _result_cache_put(cache_key, filepath)
+        return [TextContent(type="text", text=filepath)]
 
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         raise RuntimeError(f"Image transformation failed: {type(e).__name__}: {str(e)}\n\nTraceback:\n{error_details}")
 
 
-def _save_generated_image(response) -> list[TextContent]:
-    """Extract image from response and save to file."""
+def _write_image_file(filepath: str, image_data) -> None:
+    """Write image data to disk (blocking; run in a thread)."""
+    # If image_data is a base64 string, decode it; raw bytes pass through
+    if not isinstance(image_data, bytes):
+        image_data = base64.b64decode(image_data, validate=False)
+
+    # Write unbuffered via os.write to skip BufferedWriter's internal copy
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        with memoryview(image_data) as view:
+            offset = 0
+            while offset < len(view):
+                offset += os.write(fd, view[offset:])
+        if hasattr(os, "posix_fadvise"):
+            # Generated images are rarely re-read right away; keep them out
+            # of the page cache
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+async def _save_generated_image(response) -> str:
+    """Extract image from response, save to file, and return the path."""
     # Extract base64 image data from response
     if not response.candidates or not response.candidates[0].content.parts:
         raise ValueError("No image generated")
 
     part = response.candidates[0].content.parts[0]
-    if not hasattr(part, "inline_data") or not part.inline_data:
+    inline_data = getattr(part, "inline_data", None)
+    if not inline_data:
         raise ValueError("No image data in response")
 
-    image_data = part.inline_data.data
+    image_data = inline_data.data
 
-    # Save to file with timestamp (ISO 8601 UTC format)
-    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-    filepath = OUTPUT_DIR / f"{timestamp}.png"
+    # Save to file with timestamp (ISO 8601 UTC format) plus a unique suffix
+    # so concurrent saves in the same second cannot clobber each other
+    timestamp = _utc_timestamp()
+    filepath = os.path.join(
+        _OUTPUT_DIR_STR, f"{timestamp}-{_process_tag}-{next(_file_counter):06d}.png"
+    )
 
-    # Save image data (check if it's already binary or base64-encoded)
-    import base64
-    with open(filepath, "wb") as f:
-        # If image_data is bytes, write directly; if string, decode from base64
-        if isinstance(image_data, bytes):
-            f.write(image_data)
-        else:
-            f.write(base64.b64decode(image_data))
-
-    # Return ONLY the file path as text
-    return [TextContent(type="text", text=str(filepath))]
+    # Save image data without blocking the event loop
+    await asyncio.to_thread(_write_image_file, filepath, image_data)
+
+    return filepath
 
 
 async def async_main():